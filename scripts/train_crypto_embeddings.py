@@ -3,10 +3,18 @@ Fine-tune embedding model for crypto trading using Sentence Transformers
 Trains on contrastive pairs to understand crypto-specific terminology
 """
 
-from sentence_transformers import SentenceTransformer, InputExample, losses
-from torch.utils.data import DataLoader
-import json
+from sentence_transformers import (
+    SentenceTransformer,
+    SentenceTransformerTrainer,
+    SentenceTransformerTrainingArguments,
+    losses
+)
+from sentence_transformers.training_args import BatchSamplers
+from sentence_transformers.util import mine_hard_negatives
+from datasets import config as datasets_config, load_dataset, load_from_disk
 import os
+import shutil
+import torch
 
 class CryptoEmbeddingTrainer:
     def __init__(self, base_model='all-MiniLM-L6-v2', output_dir='./models/crypto-embeddings-v1'):
@@ -14,53 +22,107 @@ class CryptoEmbeddingTrainer:
         self.output_dir = output_dir
         self.model = None
         
-    def load_training_data(self, filepath='./training-data/embeddings/crypto_pairs.json'):
-        """Load training pairs from JSON file"""
-        with open(filepath, 'r') as f:
-            data = json.load(f)
-        return data
+    def load_training_data(self, filepath='./training-data/embeddings/crypto_pairs.jsonl'):
+        """Load training pairs from a JSON or JSONL file into an Arrow-backed Dataset
+        
+        JSONL is parsed in chunks and the result is cached by `datasets`, so
+        later runs skip parsing entirely.
+        """
+        return load_dataset('json', data_files=filepath, split='train')
     
     def prepare_examples(self, data):
-        """Convert JSON data to InputExamples for training"""
-        examples = []
-        
-        for item in data:
-            # Triplet format: (anchor, positive, negative)
-            example = InputExample(
-                texts=[item['anchor'], item['positive'], item['negative']]
-            )
-            examples.append(example)
+        """Select the training columns from the loaded Dataset"""
+        # Pair format: (anchor, positive); other positives in the batch act as negatives
+        examples = data.select_columns(['anchor', 'positive'])
         
         print(f"Prepared {len(examples)} training examples")
         return examples
     
-    def train(self, training_data_path='./training-data/embeddings/crypto_pairs.json', 
-              epochs=10, batch_size=16, warmup_steps=100):
-        """Train the embedding model"""
+    def mine_negatives(self, dataset, margin=0.1):
+        """Add a hard negative to each (anchor, positive) pair using the current model
+        
+        Picks the most similar other positive that scores at least `margin`
+        below the true positive, so near-duplicates are not used as negatives.
+        """
+        mined = mine_hard_negatives(
+            dataset,
+            self.model,
+            anchor_column_name='anchor',
+            positive_column_name='positive',
+            num_negatives=1,
+            margin=margin,
+            sampling_strategy="top",
+            use_faiss=True
+        )
+        
+        print(f"Mined hard negatives for {len(mined)} training examples")
+        return mined
+    
+    def train(self, training_data_path='./training-data/embeddings/crypto_pairs.jsonl', 
+              epochs=3, batch_size=64, warmup_steps=100, hard_negatives=True):
+        """Train the embedding model
+        
+        Runs on a single GPU when launched with `python`, or with DDP when
+        launched with `torchrun --nproc_per_node=N`. `batch_size` is per device.
+        """
         
         # Load base model
         print(f"Loading base model: {self.base_model}")
         self.model = SentenceTransformer(self.base_model)
         
+        # Each optimizer step covers world_size batches, so scale warmup down
+        world_size = int(os.environ.get('WORLD_SIZE', 1))
+        
+        args = SentenceTransformerTrainingArguments(
+            output_dir=self.output_dir,
+            num_train_epochs=epochs,
+            per_device_train_batch_size=batch_size,
+            warmup_steps=warmup_steps // world_size,
+            batch_sampler=BatchSamplers.NO_DUPLICATES,
+            dataloader_num_workers=4,
+            dataloader_pin_memory=True,
+            dataloader_persistent_workers=True,
+            save_strategy="no",
+            logging_steps=10
+        )
+        
         # Load and prepare training data
         data = self.load_training_data(training_data_path)
-        train_examples = self.prepare_examples(data)
+        train_dataset = self.prepare_examples(data)
+        if hard_negatives:
+            # Under torchrun, mine once on the global main process and share the
+            # result so every rank (on every node) trains on the same rows. The
+            # scratch copy lives in the datasets cache, keyed by the torchrun run id.
+            run_id = os.environ.get('TORCHELASTIC_RUN_ID', str(os.getpid()))
+            mined_dir = os.path.join(datasets_config.HF_DATASETS_CACHE, f'crypto-mined-negatives-{run_id}')
+            with args.main_process_first(local=False, desc="Mining hard negatives"):
+                if args.process_index == 0:
+                    train_dataset = self.mine_negatives(train_dataset)
+                    if args.world_size > 1:
+                        train_dataset.save_to_disk(mined_dir)
+                else:
+                    # Load into memory so the scratch copy can be deleted below
+                    train_dataset = load_from_disk(mined_dir, keep_in_memory=True)
+            
+            if args.world_size > 1:
+                args.distributed_state.wait_for_everyone()
+                if args.process_index == 0:
+                    shutil.rmtree(mined_dir, ignore_errors=True)
         
-        # Create DataLoader
-        train_dataloader = DataLoader(train_examples, shuffle=True, batch_size=batch_size)
+        # In-batch negatives (plus mined hard negatives, when present)
+        train_loss = losses.MultipleNegativesRankingLoss(model=self.model)
         
-        # Use Triplet Loss for contrastive learning
-        train_loss = losses.TripletLoss(model=self.model)
+        trainer = SentenceTransformerTrainer(
+            model=self.model,
+            args=args,
+            train_dataset=train_dataset,
+            loss=train_loss
+        )
         
         # Training
         print(f"Starting training for {epochs} epochs...")
-        self.model.fit(
-            train_objectives=[(train_dataloader, train_loss)],
-            epochs=epochs,
-            warmup_steps=warmup_steps,
-            output_path=self.output_dir,
-            show_progress_bar=True
-        )
+        trainer.train()
+        trainer.save_model(self.output_dir)
         
         print(f"Training complete! Model saved to {self.output_dir}")
     
@@ -78,14 +140,22 @@ class CryptoEmbeddingTrainer:
             "MACD bullish crossover signal"                 # Should be dissimilar
         ]
         
-        embeddings = self.model.encode(test_sentences)
+        # Normalized embeddings stay on the device; cosine similarity is a single matmul
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        if device == 'cuda':
+            # Inference only: FP16 weights and embeddings run on tensor cores
+            self.model.half()
+        embeddings = self.model.encode(
+            test_sentences,
+            convert_to_tensor=True,
+            device=device,
+            normalize_embeddings=True
+        )
         
-        print("\nTest Embeddings Shape:", embeddings.shape)
+        print("\nTest Embeddings Shape:", tuple(embeddings.shape))
         print("\nSimilarity Matrix:")
         
-        from sklearn.metrics.pairwise import cosine_similarity
-        
-        similarity_matrix = cosine_similarity(embeddings)
+        similarity_matrix = (embeddings @ embeddings.T).cpu().numpy()
         
         # Print with sentence labels
         for i, sent in enumerate(test_sentences):
@@ -94,16 +164,19 @@ class CryptoEmbeddingTrainer:
                 if i != j:
                     print(f"  vs {j}: {similarity_matrix[i][j]:.3f}")
 
-if __name__ == "__main__":
-    # Example usage
+def main():
     trainer = CryptoEmbeddingTrainer()
     
     # Train the model
     trainer.train(
-        training_data_path='./training-data/embeddings/crypto_pairs.json',
-        epochs=10,
-        batch_size=16
+        training_data_path='./training-data/embeddings/crypto_pairs.jsonl',
+        epochs=3,
+        batch_size=64
     )
     
-    # Test embeddings
-    trainer.test_embeddings()
+    # Test embeddings (main process only under torchrun)
+    if int(os.environ.get('RANK', 0)) == 0:
+        trainer.test_embeddings()
+
+if __name__ == "__main__":
+    main()
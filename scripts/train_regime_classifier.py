@@ -6,120 +6,178 @@ Trains on labeled historical market data to predict bull/bear/sideways/volatile
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
-    TrainingArguments,
-    Trainer,
-    DataCollatorForLanguageModeling
+    BitsAndBytesConfig
 )
-from datasets import Dataset
-import json
+from peft import LoraConfig, PeftModel, get_peft_model, prepare_model_for_kbit_training
+from trl import SFTConfig, SFTTrainer
+from datasets import load_dataset
+import gc
+import os
 import torch
 
 class RegimeClassifierTrainer:
-    def __init__(self, model_name="mistralai/Mistral-7B-Instruct-v0.2", output_dir="./models/regime-classifier-v1"):
+    def __init__(self, model_name="mistralai/Mistral-7B-Instruct-v0.2", output_dir="./models/regime-classifier-v1",
+                 local_files_only=False):
         self.model_name = model_name
         self.output_dir = output_dir
+        # Set once the base model is in the HF cache (HF_HOME) to skip hub lookups
+        self.local_files_only = local_files_only
         self.model = None
         self.tokenizer = None
         
     def load_training_data(self, filepath='./training-data/regime/regime_training.jsonl'):
-        """Load training data from JSONL file"""
-        data = []
-        with open(filepath, 'r') as f:
-            for line in f:
-                data.append(json.loads(line))
+        """Load training data from JSONL file (cached as Arrow by `datasets`)"""
+        data = load_dataset('json', data_files=filepath, split='train')
         print(f"Loaded {len(data)} training examples")
         return data
     
-    def format_prompt(self, example):
-        """Format as Mistral instruction-following prompt"""
-        prompt = f"""<s>[INST] {example['instruction']}
+    @staticmethod
+    def format_prompt(example):
+        """Format as Mistral instruction-following prompt, split into prompt and answer
+        
+        The leading <s> is omitted; the tokenizer adds BOS during training.
+        """
+        prompt = f"""[INST] {example['instruction']}
 
 {example['input']}
 
-Classify the market regime as one of: bull, bear, sideways, or high-volatility [/INST] {example['output']}</s>"""
-        return prompt
+Classify the market regime as one of: bull, bear, sideways, or high-volatility [/INST]"""
+        answer = f" {example['output']}</s>"
+        return prompt, answer
     
     def prepare_dataset(self, data):
-        """Convert data to Hugging Face Dataset"""
-        formatted_data = [self.format_prompt(ex) for ex in data]
+        """Format raw examples into prompt/completion columns"""
+        format_prompt = self.format_prompt
         
-        dataset = Dataset.from_dict({
-            'text': formatted_data
-        })
+        def format_function(examples):
+            rows = [dict(zip(examples, values)) for values in zip(*examples.values())]
+            prompts, answers = zip(*(format_prompt(row) for row in rows))
+            return {'prompt': list(prompts), 'completion': list(answers)}
         
+        dataset = data.map(format_function, batched=True, remove_columns=data.column_names)
         return dataset
     
-    def tokenize_dataset(self, dataset):
-        """Tokenize the dataset"""
-        def tokenize_function(examples):
-            return self.tokenizer(
-                examples['text'],
-                truncation=True,
-                max_length=512,
-                padding='max_length'
-            )
-        
-        tokenized = dataset.map(tokenize_function, batched=True, remove_columns=['text'])
-        return tokenized
-    
     def train(self, training_data_path='./training-data/regime/regime_training.jsonl',
-              epochs=3, batch_size=4, learning_rate=2e-5):
+              epochs=3, batch_size=16, learning_rate=2e-4):
         """Train the regime classification model"""
         
-        # Load model and tokenizer
+        # Load model in 4-bit NF4 and train LoRA adapters only (QLoRA)
         print(f"Loading model: {self.model_name}")
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16
+        )
         self.model = AutoModelForCausalLM.from_pretrained(
             self.model_name,
-            torch_dtype=torch.float16,
-            device_map='auto'
+            quantization_config=bnb_config,
+            torch_dtype=torch.bfloat16,
+            attn_implementation="flash_attention_2",
+            device_map='auto',
+            use_safetensors=True,
+            low_cpu_mem_usage=True,
+            local_files_only=self.local_files_only
+        )
+        # Recompute activations in the backward pass instead of storing them
+        self.model.gradient_checkpointing_enable()
+        self.model.config.use_cache = False
+        self.model = prepare_model_for_kbit_training(self.model)
+        lora_config = LoraConfig(
+            r=16,
+            lora_alpha=32,
+            target_modules=["q_proj", "k_proj", "v_proj", "o_proj"],
+            task_type="CAUSAL_LM"
+        )
+        self.model = get_peft_model(self.model, lora_config)
+        self.model.print_trainable_parameters()
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            self.model_name,
+            local_files_only=self.local_files_only
         )
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
         self.tokenizer.pad_token = self.tokenizer.eos_token
         
         # Load and prepare data
         data = self.load_training_data(training_data_path)
         dataset = self.prepare_dataset(data)
-        tokenized_dataset = self.tokenize_dataset(dataset)
         
-        # Training arguments
-        training_args = TrainingArguments(
+        # Training arguments: pack several short prompts into each 512-token
+        # sequence; loss is computed on the completion (regime answer) only
+        training_args = SFTConfig(
             output_dir=self.output_dir,
+            max_length=512,
+            packing=True,
+            completion_only_loss=True,
+            dataset_num_proc=os.cpu_count(),
             num_train_epochs=epochs,
             per_device_train_batch_size=batch_size,
-            gradient_accumulation_steps=4,
+            gradient_accumulation_steps=1,
+            gradient_checkpointing=True,
             learning_rate=learning_rate,
-            fp16=True,
+            bf16=True,
             logging_steps=10,
             save_strategy="epoch",
             save_total_limit=2,
-            warmup_steps=100,
-            optim="adamw_torch"
+            # Packing leaves only tens of optimizer steps on the generated dataset
+            warmup_ratio=0.05,
+            torch_compile=True,
+            torch_compile_backend="inductor",
+            dataloader_num_workers=4,
+            dataloader_pin_memory=True,
+            dataloader_persistent_workers=True,
+            optim="paged_adamw_8bit"
         )
         
-        # Data collator
-        data_collator = DataCollatorForLanguageModeling(
-            tokenizer=self.tokenizer,
-            mlm=False
-        )
+        # Allow TF32 tensor cores for any remaining FP32 matmuls
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
         
-        # Trainer
-        trainer = Trainer(
+        # Trainer (tokenizes the dataset; packed samples are kept apart via
+        # position_ids in the Flash-Attention kernel)
+        trainer = SFTTrainer(
             model=self.model,
             args=training_args,
-            train_dataset=tokenized_dataset,
-            data_collator=data_collator
+            train_dataset=dataset,
+            processing_class=self.tokenizer
         )
         
         # Train
         print("Starting training...")
         trainer.train()
         
-        # Save
+        # Save the LoRA adapter, then merge it into the base so the backend
+        # text-generation pipeline can load output_dir as a plain model
+        adapter_dir = os.path.join(self.output_dir, 'adapter')
+        print(f"Saving adapter to {adapter_dir}")
+        self.model.save_pretrained(adapter_dir)
+        
+        # Free the 4-bit model and optimizer state before loading the bf16 base;
+        # collect first so reference cycles don't pin them on the GPU
+        del trainer
+        self.model = None
+        gc.collect()
+        torch.cuda.empty_cache()
+        
+        self.merge_adapter(adapter_dir)
+        
+        print("Training complete!")
+    
+    def merge_adapter(self, adapter_dir):
+        """Merge a trained LoRA adapter into the bf16 base model and save it to output_dir"""
+        print(f"Merging adapter into {self.model_name}")
+        base_model = AutoModelForCausalLM.from_pretrained(
+            self.model_name,
+            torch_dtype=torch.bfloat16,
+            device_map='auto',
+            use_safetensors=True,
+            low_cpu_mem_usage=True,
+            local_files_only=self.local_files_only
+        )
+        self.model = PeftModel.from_pretrained(base_model, adapter_dir).merge_and_unload()
+        
         print(f"Saving model to {self.output_dir}")
         self.model.save_pretrained(self.output_dir)
         self.tokenizer.save_pretrained(self.output_dir)
-        
-        print("Training complete!")
     
     def test_classifier(self):
         """Test the trained classifier"""
@@ -127,8 +185,11 @@ Classify the market regime as one of: bull, bear, sideways, or high-volatility [
             print("Loading trained model...")
             self.model = AutoModelForCausalLM.from_pretrained(
                 self.output_dir,
-                torch_dtype=torch.float16,
-                device_map='auto'
+                torch_dtype=torch.bfloat16,
+                device_map='auto',
+                use_safetensors=True,
+                low_cpu_mem_usage=True,
+                local_files_only=self.local_files_only
             )
             self.tokenizer = AutoTokenizer.from_pretrained(self.output_dir)
         
@@ -167,30 +228,41 @@ MACD signal: neutral""",
         
         print("\n=== Testing Regime Classifier ===\n")
         
-        for i, test in enumerate(test_cases):
-            prompt = f"""<s>[INST] Analyze market conditions and classify regime:
+        prompts = [
+            f"""<s>[INST] Analyze market conditions and classify regime:
 
 {test['input']}
 
 Classify the market regime as one of: bull, bear, sideways, or high-volatility [/INST]"""
-            
-            inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
-            
-            outputs = self.model.generate(
-                **inputs,
-                max_new_tokens=20,
-                temperature=0.1,
-                do_sample=True
-            )
-            
-            result = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            prediction = result.split("[/INST]")[-1].strip().lower()
-            
-            # Extract just the regime label
-            for regime in ['bull', 'bear', 'sideways', 'high-volatility']:
-                if regime in prediction:
-                    prediction = regime
-                    break
+            for test in test_cases
+        ]
+        
+        # Score only the first answer token of each regime instead of generating free text
+        regimes = ['bull', 'bear', 'sideways', 'high-volatility']
+        prompt_len = len(self.tokenizer(prompts[0], add_special_tokens=False).input_ids)
+        label_ids = [
+            self.tokenizer(prompts[0] + f" {regime}", add_special_tokens=False).input_ids[prompt_len]
+            for regime in regimes
+        ]
+        if len(set(label_ids)) != len(regimes):
+            raise ValueError(f"Regime labels do not start with distinct tokens: {label_ids}")
+        
+        # Left padding so every prompt's last token sits in the final position
+        self.tokenizer.padding_side = "left"
+        inputs = self.tokenizer(
+            prompts,
+            return_tensors="pt",
+            padding=True,
+            add_special_tokens=False
+        ).to(self.model.device)
+        
+        with torch.no_grad():
+            logits = self.model(**inputs).logits[:, -1, :]
+        
+        predictions = logits[:, label_ids].argmax(-1).tolist()
+        
+        for i, (test, label) in enumerate(zip(test_cases, predictions)):
+            prediction = regimes[label]
             
             print(f"Test {i+1}:")
             print(f"  Expected: {test['expected']}")
@@ -205,8 +277,8 @@ if __name__ == "__main__":
     trainer.train(
         training_data_path='./training-data/regime/regime_training.jsonl',
         epochs=3,
-        batch_size=2,
-        learning_rate=2e-5
+        batch_size=8,
+        learning_rate=2e-4
     )
     
     # Test